@@ -22,37 +22,65 @@ from __future__ import annotations
 
 import argparse
 import datetime
+import os
 import re
 import shutil
+import stat
 import subprocess
 import sys
 import textwrap
+from collections import deque
+from contextlib import contextmanager
 from dataclasses import dataclass
-from functools import partial
+from functools import lru_cache, partial
 from io import BytesIO
+from operator import attrgetter
 from pathlib import Path, PurePath
-from typing import TYPE_CHECKING, Any, Final, assert_never
+from typing import TYPE_CHECKING, Any, Final
 
 from libarchive import (  # type: ignore[import-untyped]
     ArchiveEntry,
+    ffi,
     file_reader,
-    file_writer,
 )
-from libarchive.write import ArchiveWrite  # type: ignore[import-untyped]
+from libarchive.write import (  # type: ignore[import-untyped]
+    ArchiveWrite,
+    new_archive_write,
+)
 from PIL import Image, UnidentifiedImageError
 
 from . import converters
 
 if TYPE_CHECKING:  # pragma: no cover
-    from collections.abc import Sequence
-
-    from libarchive.read import (  # type: ignore[import-untyped]
-        ArchiveRead,
-        ArchiveWrite,
-    )
+    from collections.abc import Callable, Generator, Sequence
+    from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+    from libarchive.read import ArchiveRead  # type: ignore[import-untyped]
+
+
+ENTRY_ATTRS: Final = (
+    "uid",
+    "gid",
+    "uname",
+    "gname",
+    "atime",
+    "mtime",
+    "ctime",
+    "birthtime",
+    "rdev",
+    "rdevmajor",
+    "rdevminor",
+)
+ENTRY_ATTRS_GETTER: Final = attrgetter(*ENTRY_ATTRS)
+READ_BLOCK_SIZE: Final = 1 << 20
+WRITE_BLOCK_SIZE: Final = 1 << 20
+# Entries without Unix attributes have no file type, so they're regular
+# files or directories.
+ZIP_FILE_TYPES: Final = frozenset({0, stat.S_IFREG, stat.S_IFDIR})
+INDENT_PATTERN: Final[re.Pattern[str]] = re.compile(r"^ *(?:[*+-] +)?")
 
 
-@dataclass
+@dataclass(slots=True)
 class Parameters:
     """Parsed CLI parameters.
 
@@ -61,11 +89,14 @@ class Parameters:
             None if no conversion should be done.
         input: Path to input comic book file.
         output: Path to output CBZ file.
+        jobs: Number of processes that will be used for converting
+            images.
     """
 
     converter: converters.BaseConverter | None
     input: Path
     output: Path
+    jobs: int = 1
 
 
 def errormsg(msg: str, code: int = 0) -> None:
@@ -90,6 +121,7 @@ def errormsg(msg: str, code: int = 0) -> None:
         raise SystemExit(code) from None
 
 
+@lru_cache(maxsize=32)
 def wrap_bulleted_text(text: str, width: int) -> str:
     """Devuelve el texto ajustado al tamaño en width.
 
@@ -98,11 +130,13 @@ def wrap_bulleted_text(text: str, width: int) -> str:
     (deben ser hechas con "*" y "-") también es indentado para ajustarlo
     a estas.
 
+    Los resultados se guardan en caché, ya que los textos de ayuda son
+    los mismos cada vez que se llama a parse_params.
+
     Args:
         text: string a ajustar.
         width: tamaño máximo que debe tener cada línea.
     """
-    indent_pattern: Final[re.Pattern[str]] = re.compile(r"^ *(?:[*+-] +)?")
     new_lines: list[str] = []
 
     for line in text.split("\n"):
@@ -111,7 +145,7 @@ def wrap_bulleted_text(text: str, width: int) -> str:
         elif not line:
             new_lines.extend(textwrap.wrap(line, width))
         else:
-            indent_match: re.Match[str] | None = indent_pattern.search(line)
+            indent_match: re.Match[str] | None = INDENT_PATTERN.search(line)
             indent: str = " " * indent_match.end() if indent_match else ""
             new_lines.extend(textwrap.wrap(line, width, subsequent_indent=indent))
 
@@ -201,6 +235,16 @@ def parse_params(argv: Sequence[str] | None = None) -> Parameters:
             "increase CPU usage a lot.\n"
         ),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help=wrap(
+            "Number of processes that will be used for converting images. By "
+            "default it's the number of CPUs in the system."
+        ),
+    )
     parser.add_argument(
         "input",
         metavar="INPUT-FILE",
@@ -215,73 +259,149 @@ def parse_params(argv: Sequence[str] | None = None) -> Parameters:
         help="Path to the output CBZ file.",
     )
     params: argparse.Namespace = parser.parse_args(argv)
-    converter: converters.BaseConverter
+    if params.jobs < 1:
+        parser.error("--jobs must be a number greater than 0")
+
     output: Path = Path(
         params.input.with_suffix(".cbz") if params.output is None else params.output
     )
+    if params.format is converters.ImageFormat.NO_CHANGE:
+        return Parameters(
+            converter=None, input=params.input, output=output, jobs=params.jobs
+        )
 
-    match params.format:
-        case converters.ImageFormat.JPEG:
-            converter = converters.JpegConverter.parse_options(params.options)
-        case converters.ImageFormat.JPEGLI:
-            converter = converters.JpegliConverter.parse_options(params.options)
-        case converters.ImageFormat.JPEGXL:
-            converter = converters.JpegXLConverter.parse_options(params.options)
-        case converters.ImageFormat.PNG:
-            converter = converters.PngConverter.parse_options(params.options)
-            if params.quality is not None:
-                if params.quality not in converters.PNG_RANGE:
-                    parser.error("--quality for png only admits numbers from 0 to 9")
-                converter.quality = params.quality
-
-        case converters.ImageFormat.NO_CHANGE:
-            return Parameters(converter=None, input=params.input, output=output)
-        case _:  # pragma: no cover
-            assert_never(params.format)
-
-    if params.quality is not None and params.format in (
-        converters.ImageFormat.JPEG,
-        converters.ImageFormat.JPEGXL,
-        converters.ImageFormat.JPEGLI,
-    ):
-        if params.quality not in converters.JPEG_RANGE:
+    converter: converters.BaseConverter = converters.CONVERTERS[
+        params.format
+    ].parse_options(params.options)
+
+    if params.quality is not None:
+        quality_range: range = (
+            converters.PNG_RANGE
+            if params.format is converters.ImageFormat.PNG
+            else converters.JPEG_RANGE
+        )
+        if params.quality not in quality_range:
             parser.error(
-                f"--quality for {params.format} only admits numbers from 0 to 100"
+                f"--quality for {params.format} only admits numbers from "
+                f"{quality_range.start} to {quality_range.stop - 1}"
             )
         converter.quality = params.quality
 
+    if isinstance(converter, converters.JpegXLConverter) and params.jobs > 1:
+        # Each process encodes its own image, so the CPUs are split between
+        # them instead of starting a thread per CPU in each one.
+        converter.num_threads = max((os.cpu_count() or 1) // params.jobs, 1)
+
     parsed: Parameters = Parameters(
-        converter=converter, input=params.input, output=output
+        converter=converter, input=params.input, output=output, jobs=params.jobs
     )
     return parsed
 
 
 def get_entry_attrs(entry: ArchiveEntry) -> dict[str, Any]:
     """Get metadata from the entry and return it if they're not None."""
-    attr_names: tuple[str, ...] = (
-        "uid",
-        "gid",
-        "uname",
-        "gname",
-        "atime",
-        "mtime",
-        "ctime",
-        "birthtime",
-        "rdev",
-        "rdevmajor",
-        "rdevminor",
-    )
-    return {i: attr for i in attr_names if (attr := getattr(entry, i)) is not None}
+    return {
+        name: attr
+        for name, attr in zip(ENTRY_ATTRS, ENTRY_ATTRS_GETTER(entry), strict=True)
+        if attr is not None
+    }
+
+
+def read_entry(entry: ArchiveEntry) -> bytes:
+    """Reads the data of an entry and returns it.
+
+    The blocks are copied once into a bytes object. BytesIO objects
+    created from it share its memory until they're written or their
+    buffer is exported with getbuffer(). Pillow reads them without
+    copying the data again, but the cjpegli and jpegtran paths call
+    getbuffer() to pass the data to the encoder, which makes a copy.
+
+    If the size of the entry is known it's read in blocks of that size,
+    up to READ_BLOCK_SIZE bytes, so libarchive is called a few times per
+    page instead of once for each 4 KiB. The cap stops a crafted header
+    that claims a huge size from forcing a huge allocation before any
+    data is read.
+    """
+    size: int | None = entry.size
+    if not size:
+        return b"".join(entry.get_blocks())
+
+    return b"".join(entry.get_blocks(block_size=min(size, READ_BLOCK_SIZE)))
+
+
+def convert_image(converter: converters.BaseConverter, data: bytes) -> bytes | None:
+    """Converts an image and returns it.
+
+    It's a module-level function so it can be used by worker processes.
+
+    Args:
+        converter: Converter that will be used to convert the image.
+        data: Image data.
+
+    Returns:
+        The converted image or None if Pillow can't identify if data is
+        an image.
+
+    Raises:
+        subprocess.CalledProcessError: If an external encoder fails.
+    """
+    in_buffer: BytesIO
+    with BytesIO(data) as in_buffer:
+        try:
+            return converter.convert(in_buffer)
+
+        except UnidentifiedImageError:
+            return None
+
+        except subprocess.CalledProcessError as err:
+            # stderr must be passed as a positional argument, otherwise it's
+            # lost when the exception is sent from a worker process.
+            raise subprocess.CalledProcessError(
+                err.returncode, err.cmd, err.output, err.stderr
+            ) from None
+
+
+@dataclass(slots=True)
+class PendingEntry:
+    """Entry that is waiting to be stored in the .cbz file.
+
+    Attributes:
+        name: Path to the file in the archive that will saved.
+        pathname: Path to the file in the input comic book archive.
+        filetype: File type of the entry.
+        perm: Permissions of the entry.
+        attrs: Metadata from the entry.
+        data: Original data of the entry.
+        result: Converted image. It's None if the entry must be stored
+            without conversion.
+    """
+
+    name: str
+    pathname: str
+    filetype: int
+    perm: int
+    attrs: dict[str, Any]
+    data: bytes
+    result: Future[bytes | None] | None
 
 
 class EntryStorer:
     """Class for storing files into the .cbz file."""
 
-    archive: ArchiveEntry
+    archive: ArchiveWrite
     converter: converters.BaseConverter | None
+    executor: Executor | None
+    max_pending: int
+    mtime: float
+    pending: deque[PendingEntry]
 
     def __init__(
-        self, archive: ArchiveWrite, converter: converters.BaseConverter | None
+        self,
+        archive: ArchiveWrite,
+        converter: converters.BaseConverter | None,
+        executor: Executor | None = None,
+        max_pending: int = 1,
+        mtime: float | None = None,
     ) -> None:
         """Initializes the object.
 
@@ -289,68 +409,251 @@ class EntryStorer:
             archive: Output .cbz file
             converter: Converter that will be used to convert images. If
                 None the no conversion will be done.
+            executor: Executor where images will be converted. If None
+                images will be converted in the current process.
+            max_pending: Number of entries that can wait for their
+                conversion before storing the oldest one. It's only used
+                if executor is not None.
+            mtime: Modification time of the converted images. If None
+                the time when the object is created will be used.
         """
         self.archive = archive
         self.converter = converter
+        self.executor = executor
+        self.max_pending = max_pending
+        self.mtime = (
+            datetime.datetime.now().astimezone().timestamp() if mtime is None else mtime
+        )
+        self.pending = deque()
 
     def save_entry(self, entry: ArchiveEntry, name: str) -> None:
         """Saves an entry from the input comic book to the .cbz file.
 
+        If there is an executor the entry will be stored after its
+        conversion finishes, keeping the order of the entries. The old
+        and new names are printed when the entry is stored.
+
         Args:
             entry: Entry from the input comic book archive.
             name: Path to the file in the archive that will saved.
         """
-        simple_save = partial(
-            self.archive.add_file_from_memory,
-            entry_path=name,
-            entry_size=entry.size,
+        # The whole entry is read before storing it, so its data is written
+        # with a single call to libarchive instead of one call per block.
+        data: bytes = read_entry(entry)
+        if self.converter is None:
+            self.archive.add_file_from_memory(
+                name,
+                len(data),
+                data,
+                entry.filetype,
+                entry.perm,
+                **get_entry_attrs(entry),
+            )
+            print(f"{entry.pathname} → {name}")
+            return
+
+        pending: PendingEntry = PendingEntry(
+            name=name,
+            pathname=entry.pathname,
             filetype=entry.filetype,
-            permission=entry.perm,
-            **get_entry_attrs(entry),
+            perm=entry.perm,
+            attrs=get_entry_attrs(entry),
+            data=data,
+            result=None,
         )
 
-        if self.converter is None:
-            simple_save(entry_data=entry.get_blocks())
+        if self.executor is None:
+            self._store(pending, partial(convert_image, self.converter, data))
             return
 
-        in_buffer: BytesIO
-        with BytesIO() as in_buffer:
-            for block in entry.get_blocks():
-                in_buffer.write(block)
-
-            try:
-                img_data: bytes = self.converter.convert(in_buffer)
-
-            except UnidentifiedImageError:
-                errormsg(
-                    f'Cannot identify if "{entry.pathname}" is an image. '
-                    "Skipping its conversion..."
-                )
-                simple_save(entry_data=in_buffer)
-                return
-
-            except subprocess.CalledProcessError as err:
-                errormsg(
-                    (
-                        f'An error happened while encoding "{entry.pathname}": '
-                        f"{err.stderr.decode()}"
-                    ),
-                    1,
-                )
-
-            entry_attrs: dict[str, Any] = get_entry_attrs(entry)
-            entry_attrs["mtime"] = datetime.datetime.now().astimezone().timestamp()
+        pending.result = self.executor.submit(convert_image, self.converter, data)
+        self.pending.append(pending)
+        if len(self.pending) >= self.max_pending:
+            self._store_next()
 
+    def save_dir(self, entry: ArchiveEntry) -> None:
+        """Saves a directory entry to the .cbz file.
+
+        Args:
+            entry: Directory entry from the input comic book archive.
+        """
+        if not self.pending:
             self.archive.add_file_from_memory(
-                name,
-                len(img_data),
-                img_data,
+                entry.pathname,
+                0,
+                b"",
                 entry.filetype,
                 entry.perm,
-                **entry_attrs,
+                **get_entry_attrs(entry),
             )
             return
 
+        self.pending.append(
+            PendingEntry(
+                name=entry.pathname,
+                pathname=entry.pathname,
+                filetype=entry.filetype,
+                perm=entry.perm,
+                attrs=get_entry_attrs(entry),
+                data=b"",
+                result=None,
+            )
+        )
+
+    def flush(self) -> None:
+        """Stores all the entries that are waiting for their conversion."""
+        while self.pending:
+            self._store_next()
+
+    def _store_next(self) -> None:
+        pending: PendingEntry = self.pending.popleft()
+        if pending.result is None:
+            self.archive.add_file_from_memory(
+                pending.name,
+                len(pending.data),
+                pending.data,
+                pending.filetype,
+                pending.perm,
+                **pending.attrs,
+            )
+        else:
+            self._store(pending, pending.result.result)
+
+    def _store(
+        self, pending: PendingEntry, convert: Callable[[], bytes | None]
+    ) -> None:
+        try:
+            img_data: bytes | None = convert()
+
+        except subprocess.CalledProcessError as err:
+            errormsg(
+                (
+                    f'An error happened while encoding "{pending.pathname}": '
+                    f"{err.stderr.decode()}"
+                ),
+                1,
+            )
+            return
+
+        if img_data is None:
+            errormsg(
+                f'Cannot identify if "{pending.pathname}" is an image. '
+                "Skipping its conversion..."
+            )
+            self.archive.add_file_from_memory(
+                pending.name,
+                len(pending.data),
+                pending.data,
+                pending.filetype,
+                pending.perm,
+                **pending.attrs,
+            )
+            print(f"{pending.pathname} → {pending.name}")
+            return
+
+        entry_attrs: dict[str, Any] = dict(pending.attrs)
+        entry_attrs["mtime"] = self.mtime
+
+        self.archive.add_file_from_memory(
+            pending.name,
+            len(img_data),
+            img_data,
+            pending.filetype,
+            pending.perm,
+            **entry_attrs,
+        )
+        print(f"{pending.pathname} → {pending.name}")
+
+
+@contextmanager
+def archive_reader(path: Path) -> Generator[ArchiveRead, None, None]:
+    """Opens the input archive and yields a reader for it.
+
+    libarchive reads the file in blocks of READ_BLOCK_SIZE bytes instead
+    of its default of 4 KiB, so each page is read with a few read()
+    calls instead of hundreds of them.
+    """
+    archive: ArchiveRead
+    with file_reader(str(path), block_size=READ_BLOCK_SIZE) as archive:
+        yield archive
+
+
+@contextmanager
+def archive_writer(path: Path) -> Generator[ArchiveWrite, None, None]:
+    """Creates the output .cbz file and yields a writer for it.
+
+    Entries are stored without compression. libarchive writes to the
+    file in blocks of WRITE_BLOCK_SIZE bytes instead of its default of
+    10 KiB, so each page is written with a few write() calls instead of
+    hundreds of them. The last block isn't padded.
+    """
+    archive_p: Any
+    with new_archive_write("zip", options="compression=store") as archive_p:
+        ffi.write_set_bytes_in_last_block(archive_p, 1)
+        ffi.write_set_bytes_per_block(archive_p, WRITE_BLOCK_SIZE)
+        ffi.write_open_filename(archive_p, os.fsencode(path))
+        yield ArchiveWrite(archive_p, "utf-8")
+
+
+def stored_zip_names(path: Path) -> list[str] | None:
+    """Returns the names of the files in a ZIP file that stores them.
+
+    Returns:
+        The names of the regular files in the archive, or None if path
+        is not a ZIP file, if any entry is compressed or encrypted, if
+        there are entries with the same name, if any entry is not a
+        regular file or a directory (like symlinks) or if the archive
+        has a comment. These are things that writing each entry again
+        wouldn't keep.
+    """
+    # It's imported here because it's only needed when images aren't
+    # converted.
+    import zipfile  # noqa: PLC0415
+
+    infolist: list[zipfile.ZipInfo]
+    try:
+        with zipfile.ZipFile(path) as zip_file:
+            if zip_file.comment:
+                return None
+            infolist = zip_file.infolist()
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+    if any(
+        info.compress_type != zipfile.ZIP_STORED
+        or info.flag_bits & 0x1
+        or stat.S_IFMT(info.external_attr >> 16) not in ZIP_FILE_TYPES
+        for info in infolist
+    ):
+        return None
+    if len({info.filename.strip("/") for info in infolist}) != len(infolist):
+        return None
+
+    return [info.filename for info in infolist if not info.is_dir()]
+
+
+def copy_stored_zip(input_path: Path, output_path: Path) -> bool:
+    """Copies the input file if it's a ZIP file without compression.
+
+    These files already are valid .cbz files, so if the images aren't
+    converted they're copied instead of writing each entry again.
+
+    Returns:
+        True if the file was copied.
+    """
+    if output_path.exists() and output_path.samefile(input_path):
+        return False
+
+    names: list[str] | None = stored_zip_names(input_path)
+    if names is None:
+        return False
+
+    shutil.copyfile(input_path, output_path)
+    name: str
+    for name in names:
+        print(f"{name} → {name}")
+    return True
+
 
 def create_new_name(old_name: str, converter: converters.BaseConverter | None) -> str:
     """Returns a new name where a file must be saved in the CBZ file."""
@@ -369,53 +672,68 @@ def main(argv: Sequence[str] | None = None) -> None:
             use sys.argv.
     """
     params: Parameters = parse_params(argv)
+    if params.converter is None and copy_stored_zip(params.input, params.output):
+        return
+
+    executor: ProcessPoolExecutor | None = None
+    if params.converter is not None and params.jobs > 1:
+        # It's imported here because it's not needed if images aren't
+        # converted or if they're converted in the current process.
+        import multiprocessing  # noqa: PLC0415
+        from concurrent.futures import ProcessPoolExecutor  # noqa: PLC0415
+
+        # forkserver avoids copying the state of the main process to the
+        # workers and importing the encoders for each image.
+        executor = ProcessPoolExecutor(
+            params.jobs, mp_context=multiprocessing.get_context("forkserver")
+        )
+
     input_arc: ArchiveRead
     output_arc: ArchiveWrite
-    with (
-        file_reader(str(params.input)) as input_arc,
-        file_writer(
-            str(params.output), "zip", options="compression=store"
-        ) as output_arc,
-    ):
-        entry_storer: EntryStorer = EntryStorer(output_arc, params.converter)
-        names: set[str] = set()
-        entry: ArchiveEntry
-        for entry in input_arc:
-            if entry.isdir:
-                stripped: str = entry.pathname.strip("/")
-                if stripped in names:
-                    errormsg(
-                        (
-                            "Two files in the output CBZ file got the same "
-                            f"name due to the conversion: {entry.pathname}"
-                        ),
-                        1,
-                    )
-                names.add(stripped)
-                output_arc.add_file_from_memory(
-                    entry.pathname,
-                    0,
-                    b"",
-                    entry.filetype,
-                    entry.perm,
-                    **get_entry_attrs(entry),
-                )
-
-            elif entry.isreg:
-                new_name: str = create_new_name(entry.pathname, params.converter)
-                stripped = new_name.strip("/")
-                if stripped in names:
-                    errormsg(
-                        (
-                            "Two files in the output CBZ file got the same "
-                            f"name due to the conversion: {entry.pathname}"
-                        ),
-                        1,
-                    )
-                names.add(stripped)
-
-                entry_storer.save_entry(entry, new_name)
-                print(f"{entry.pathname} → {new_name}")
+    try:
+        with (
+            archive_reader(params.input) as input_arc,
+            archive_writer(params.output) as output_arc,
+        ):
+            entry_storer: EntryStorer = EntryStorer(
+                output_arc, params.converter, executor, params.jobs * 2
+            )
+            names: set[str] = set()
+            entry: ArchiveEntry
+            for entry in input_arc:
+                if entry.isdir:
+                    stripped: str = entry.pathname.strip("/")
+                    if stripped in names:
+                        errormsg(
+                            (
+                                "Two files in the output CBZ file got the same "
+                                f"name due to the conversion: {entry.pathname}"
+                            ),
+                            1,
+                        )
+                    names.add(stripped)
+                    entry_storer.save_dir(entry)
+
+                elif entry.isreg:
+                    new_name: str = create_new_name(entry.pathname, params.converter)
+                    stripped = new_name.strip("/")
+                    if stripped in names:
+                        errormsg(
+                            (
+                                "Two files in the output CBZ file got the same "
+                                f"name due to the conversion: {entry.pathname}"
+                            ),
+                            1,
+                        )
+                    names.add(stripped)
+
+                    entry_storer.save_entry(entry, new_name)
+
+            entry_storer.flush()
+
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -19,23 +19,30 @@
 from __future__ import annotations
 
 import abc
+import shutil
 import subprocess
+import threading
 from contextlib import contextmanager
 from enum import IntEnum, StrEnum
+from functools import cache, lru_cache
 from io import BytesIO
-from typing import TYPE_CHECKING, Any, ClassVar, Final, Self
+from typing import IO, TYPE_CHECKING, Any, ClassVar, Final, Self, cast
 
-import pillow_jxl
-from PIL import Image
+from PIL import Image, ImageChops
 
 if TYPE_CHECKING:  # pragma: no cover
-    from collections.abc import Generator
+    from collections.abc import Generator, Sequence
+    from types import ModuleType
+
+    import pillow_jxl
 
 JPEG_RANGE: Final = range(101)
 PNG_RANGE: Final = range(10)
 JPEG_DEFAULT: Final = 90
 PNG_DEFAULT: Final = 6
 LOSSLESS_QUALITY: Final = 100
+JPEG_METADATA: Final = ("dpi", "icc_profile", "exif", "comment")
+BOOL_VALUES: Final = {"true": True, "1": True, "false": False, "0": False}
 
 
 class ImageFormat(StrEnum):
@@ -59,27 +66,173 @@ def parse_str_bool(value: str, name: str) -> bool:
     Raises:
         ValueError: If the value is not "1", "0", "true" or "false".
     """
-    value = value.lower()
-    if value in {"true", "1"}:
-        return True
-    if value in {"false", "0"}:
-        return False
-    msg: str = f'{name} value must be "1", "0", "true" or "false"'
-    raise ValueError(msg)
+    try:
+        return BOOL_VALUES[value.lower()]
+    except KeyError:
+        msg: str = f'{name} value must be "1", "0", "true" or "false"'
+        raise ValueError(msg) from None
 
 
 def remove_alpha(img: Image.Image) -> Image.Image:
     """Removes img alpha channel replacing it with a white background."""
     output_mode = "L" if img.mode in {"LA", "La"} else "RGB"
-    with Image.new("RGBA", img.size, "WHITE") as background:
-        if img.mode != "RGBA":
-            with img:
-                img = img.convert("RGBA")
-
+    if img.mode not in {"LA", "RGBA"}:
         with img:
-            background.alpha_composite(img)
-            converted: Image.Image = background.convert(output_mode)
-            return converted
+            img = img.convert("RGBA")
+
+    # Pasting img using itself as mask blends it with the background in a
+    # single step, without converting the result back from RGBA.
+    background: Image.Image = Image.new(output_mode, img.size, "WHITE")
+    with img:
+        background.paste(img, mask=img)
+    return background
+
+
+def fits_in_palette(img: Image.Image) -> bool:
+    """Returns True if img has 256 colors or less.
+
+    A sample of the pixels is checked first, so images with a lot of
+    colors don't need a full scan to know that they don't fit.
+    """
+    sample: Image.Image
+    with img.resize(
+        (max(img.width // 16, 1), max(img.height // 16, 1)),
+        Image.Resampling.NEAREST,
+    ) as sample:
+        if sample.getcolors() is None:
+            return False
+    return img.getcolors() is not None
+
+
+def is_grayscale(img: Image.Image) -> bool:
+    """Returns True if img is an RGB image where every pixel is gray.
+
+    A sample of the pixels is checked first, so most color images don't
+    need a full scan.
+    """
+
+    def channels_equal(image: Image.Image) -> bool:
+        red, green, blue = image.split()
+        return not (
+            ImageChops.difference(red, green).getbbox()
+            or ImageChops.difference(green, blue).getbbox()
+        )
+
+    if img.mode != "RGB":
+        return False
+
+    sample: Image.Image
+    with img.resize(
+        (max(img.width // 16, 1), max(img.height // 16, 1)),
+        Image.Resampling.NEAREST,
+    ) as sample:
+        if not channels_equal(sample):
+            return False
+    return channels_equal(img)
+
+
+@cache
+def find_program(name: str) -> str:
+    """Returns the path to an external program.
+
+    The search is done once per program instead of once per image. If
+    the program isn't found its name is returned, so the error is raised
+    when it's executed.
+    """
+    return shutil.which(name) or name
+
+
+def write_input(stdin: IO[bytes], data: memoryview) -> None:
+    """Writes data to the stdin of a process and closes it."""
+    try:
+        stdin.write(data)
+        stdin.close()
+    except BrokenPipeError:
+        # The process exited without reading all the data, its exit code
+        # tells what happened.
+        pass
+
+
+def read_output(pipe: IO[bytes], out: list[bytes]) -> None:
+    """Reads a pipe until it's closed and appends its data to out."""
+    out.append(pipe.read())
+
+
+def run_program(args: Sequence[str], data: memoryview) -> bytes:
+    """Runs a program that reads data from stdin and returns its stdout.
+
+    subprocess.run writes the input in chunks of PIPE_BUF bytes from a
+    selector loop, which is slow for images of several megabytes. Here
+    the input is written with a single call from a thread while the
+    output is read until the program closes it.
+
+    Raises:
+        subprocess.CalledProcessError: If the program exits with an
+            error.
+    """
+    process: subprocess.Popen[bytes]
+    with subprocess.Popen(  # noqa: S603
+        args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ) as process:
+        # The pipes are never None because all of them were requested.
+        stdout_pipe: IO[bytes] = cast("IO[bytes]", process.stdout)
+        stderr: list[bytes] = []
+        threads: tuple[threading.Thread, ...] = (
+            threading.Thread(target=write_input, args=(process.stdin, data)),
+            # stderr is read at the same time, so the program can't get
+            # blocked if it writes a lot of messages.
+            threading.Thread(target=read_output, args=(process.stderr, stderr)),
+        )
+        thread: threading.Thread
+        for thread in threads:
+            thread.start()
+        stdout: bytes = stdout_pipe.read()
+        for thread in threads:
+            thread.join()
+        returncode: int = process.wait()
+
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args, stdout, b"".join(stderr))
+    return stdout
+
+
+@cache
+def load_jxl_plugin() -> ModuleType:
+    """Imports pillow_jxl and returns it.
+
+    Importing it registers the JPEG XL plugin in Pillow. It's done the
+    first time an image is opened instead of when this module is
+    imported, so it isn't loaded if no image is converted.
+    """
+    import pillow_jxl  # noqa: PLC0415
+
+    return pillow_jxl
+
+
+def open_image(in_buffer: BytesIO) -> Image.Image:
+    """Opens an image with Pillow, supporting JPEG XL images too."""
+    load_jxl_plugin()
+    return Image.open(in_buffer)
+
+
+@lru_cache(maxsize=16)
+def get_jxl_encoder(
+    mode: str, quality: int, effort: int, decoding_speed: int, num_threads: int
+) -> pillow_jxl.Encoder:
+    """Returns an encoder for transcoding JPEG files to JPEG XL.
+
+    Encoders are shared by all the images that use the same settings.
+    """
+    return load_jxl_plugin().Encoder(  # type: ignore[no-any-return]
+        mode=mode,
+        lossless=False,
+        quality=quality,
+        decoding_speed=decoding_speed,
+        effort=effort,
+        use_container=True,
+        use_original_profile=True,
+        num_threads=num_threads,
+    )
 
 
 @contextmanager
@@ -97,6 +250,7 @@ def view_manager(buffer: BytesIO) -> Generator[memoryview, None, None]:
 class BaseConverter(metaclass=abc.ABCMeta):
     """Base class for image converters."""
 
+    __slots__ = ("quality",)
     format: ClassVar[ImageFormat]
     pil_format: ClassVar[str | None]
     extension: ClassVar[str]
@@ -174,6 +328,7 @@ class JpegSubsamplingEnum(StrEnum):
 class JpegConverter(BaseConverter):
     """Converter to JPEG images."""
 
+    __slots__ = ("keep_rgb", "optimize", "progressive", "subsampling")
     format = ImageFormat.JPEG
     pil_format = "JPEG"
     extension = ".jpg"
@@ -181,6 +336,7 @@ class JpegConverter(BaseConverter):
     quality: int
     subsampling: JpegSubsamplingEnum | None
     optimize: bool
+    keep_rgb: bool
     progressive: bool
 
     def __init__(
@@ -198,7 +354,8 @@ class JpegConverter(BaseConverter):
             quality: Quality of the compressed image.
             optimize: If True does an extra step when encoding the image
                 to optimize the compression.
-            keep_rgb: If True use RGB instead of YCbCr.
+            keep_rgb: If True use RGB instead of YCbCr. subsampling is
+                ignored if it's True.
             progressive: If True use progressive encoding.
             subsampling: Subsampling that will be used by the encoder.
                 Available values:
@@ -262,8 +419,14 @@ class JpegConverter(BaseConverter):
     def save(self, img: Image.Image, info: dict[str, Any]) -> bytes:
         """Saves the image as a JPEG and returns it as a bytes object."""
         metadata: dict[str, Any] = self.get_metadata(info)
-        if self.subsampling is not None and not (
-            img.format != "JPEG" and self.subsampling == JpegSubsamplingEnum.KEEP
+        # Subsampling is only applied to chroma channels, so it can't be used
+        # when the image is stored as RGB.
+        if (
+            self.subsampling is not None
+            and not self.keep_rgb
+            and not (
+                img.format != "JPEG" and self.subsampling == JpegSubsamplingEnum.KEEP
+            )
         ):
             metadata["subsampling"] = self.subsampling
 
@@ -276,7 +439,7 @@ class JpegConverter(BaseConverter):
                 optimize=self.optimize,
                 progressive=self.progressive,
                 keep_rgb=self.keep_rgb,
-                **self.get_metadata(info),
+                **metadata,
             )
             return img_data.getvalue()
 
@@ -300,7 +463,7 @@ class JpegConverter(BaseConverter):
                 in_buffer is an image.
         """
         img: Image.Image
-        with Image.open(in_buffer) as img:
+        with open_image(in_buffer) as img:
             info: dict[str, Any] = img.info
             if img.mode in {"L", "RGB", "CMYK"}:
                 return self.save(img, info)
@@ -322,11 +485,9 @@ class JpegConverter(BaseConverter):
 
     def get_metadata(self, meta: dict[str, Any]) -> dict[str, Any]:
         """Returns metadata that must be saved to the JPEG file."""
-        return {
-            k: v
-            for k, v in meta.items()
-            if k in {"dpi", "icc_profile", "exif", "comment"}
-        }
+        # Only the few supported keys are looked up, instead of going through
+        # every key that Pillow put in info.
+        return {k: meta[k] for k in JPEG_METADATA if k in meta}
 
 
 class JpegliProgressiveEnum(IntEnum):
@@ -349,6 +510,14 @@ class JpegliSubsamplingEnum(StrEnum):
 class JpegliConverter(BaseConverter):
     """Converter to JPEG images using cjpegli encoder."""
 
+    __slots__ = (
+        "adaptive_quantization",
+        "fixed_code",
+        "progressive",
+        "std_quant",
+        "subsampling",
+        "xyb",
+    )
     format = ImageFormat.JPEGLI
     pil_format = None
     extension = ".jpg"
@@ -437,20 +606,20 @@ class JpegliConverter(BaseConverter):
         for name, value in cls._parse_opt(options):
             match name:
                 case "progressive":
-                    try:
+                    lowered: str = value.lower()
+                    if value in {"0", "1", "2"}:
                         progressive = JpegliProgressiveEnum(int(value))
-                    except ValueError as err1:
-                        try:
-                            progressive = JpegliProgressiveEnum(
-                                2 if parse_str_bool(value, name) else 0
-                            )
-                        except ValueError as err2:
-                            msg: str = (
-                                'progressive value must be "true", "false", '
-                                '"0", "1" or "2"'
-                            )
-                            err2.__cause__ = err1
-                            raise ValueError(msg) from err2
+                    elif lowered in BOOL_VALUES:
+                        progressive = (
+                            JpegliProgressiveEnum.TWO
+                            if BOOL_VALUES[lowered]
+                            else JpegliProgressiveEnum.ZERO
+                        )
+                    else:
+                        msg: str = (
+                            'progressive value must be "true", "false", "0", "1" or "2"'
+                        )
+                        raise ValueError(msg)
 
                 case "subsampling":
                     if value not in {"4:4:4", "4:4:0", "4:2:2", "4:2:0"}:
@@ -485,7 +654,7 @@ class JpegliConverter(BaseConverter):
 
     def _get_params(self) -> list[str]:
         params: list[str] = [
-            "cjpegli",
+            find_program("cjpegli"),
             "--quiet",
             f"--quality={self.quality}",
             f"--progressive_level={self.progressive}",
@@ -519,24 +688,33 @@ class JpegliConverter(BaseConverter):
 
             buffer: BytesIO
             with BytesIO() as buffer:
-                img.save(
-                    buffer,
-                    format="PNG",
-                    compress_level=0,
-                    icc_profile=info.get("icc_profile"),
-                    exif=info.get("exif"),
-                    dpi=info.get("dpi"),
-                )
+                if any(info.get(i) for i in ("icc_profile", "exif", "dpi")):
+                    img.save(
+                        buffer,
+                        format="PNG",
+                        compress_level=0,
+                        icc_profile=info.get("icc_profile"),
+                        exif=info.get("exif"),
+                        dpi=info.get("dpi"),
+                    )
+
+                else:
+                    # PPM can't store metadata, but it stores raw pixels, so
+                    # it's faster to write and to read by cjpegli than PNG.
+                    if img.mode == "P":
+                        new_img = img.convert("RGB")
+                        img.close()
+                        img = new_img
+                    img.save(buffer, format="PPM")
+
                 img.close()
 
                 view: memoryview
                 with view_manager(buffer) as view:
-                    return subprocess.run(  # noqa: S603
-                        self._get_params(), input=view, capture_output=True, check=True
-                    ).stdout
+                    return run_program(self._get_params(), view)
 
         img: Image.Image
-        with Image.open(in_buffer) as img:
+        with open_image(in_buffer) as img:
             # Workaround for a failure that happens when converting 1-bit images
             if img.mode == "1":
                 limg: Image.Image = img.convert("L")
@@ -552,9 +730,7 @@ class JpegliConverter(BaseConverter):
 
         in_view: memoryview
         with view_manager(in_buffer) as in_view:
-            return subprocess.run(  # noqa: S603
-                self._get_params(), input=in_view, capture_output=True, check=True
-            ).stdout
+            return run_program(self._get_params(), in_view)
 
 
 class JpegXLEffortEnum(IntEnum):
@@ -584,6 +760,7 @@ class JpegXLDecodingSpeedEnum(IntEnum):
 class JpegXLConverter(BaseConverter):
     """Converter to JPEG XL images."""
 
+    __slots__ = ("decoding_speed", "effort", "jpegtran", "num_threads")
     format = ImageFormat.JPEGXL
     pil_format = "JXL"
     extension = ".jxl"
@@ -592,6 +769,7 @@ class JpegXLConverter(BaseConverter):
     effort: JpegXLEffortEnum
     decoding_speed: JpegXLDecodingSpeedEnum
     jpegtran: bool
+    num_threads: int
 
     def __init__(
         self,
@@ -600,6 +778,7 @@ class JpegXLConverter(BaseConverter):
         decoding_speed: JpegXLDecodingSpeedEnum = JpegXLDecodingSpeedEnum.ZERO,
         *,
         jpegtran: bool = False,
+        num_threads: int = -1,
     ):
         """Initializes the object.
 
@@ -615,6 +794,8 @@ class JpegXLConverter(BaseConverter):
                 before converting JPEG XL. It helps to recover JPEG
                 images that have an invalid bitstream that can't be
                 decoded by the JPEG XL encoder.
+            num_threads: Number of threads used by the encoder for each
+                image. -1 means one thread per CPU.
 
         Raises:
             ValueError: If any of the args is invalid.
@@ -627,6 +808,7 @@ class JpegXLConverter(BaseConverter):
         self.effort = effort
         self.decoding_speed = decoding_speed
         self.jpegtran = jpegtran
+        self.num_threads = num_threads
 
     @classmethod
     def parse_options(cls, options: str) -> Self:
@@ -661,29 +843,32 @@ class JpegXLConverter(BaseConverter):
         return cls(effort=effort, decoding_speed=decoding_speed, jpegtran=jpegtran)
 
     def _jpg_to_jxl(self, in_buffer: BytesIO, img: Image.Image) -> bytes:
-        enc: pillow_jxl.Encoder = pillow_jxl.Encoder(  # type: ignore[call-arg]
-            mode=img.mode,
-            lossless=False,
-            quality=self.quality,
-            decoding_speed=int(self.decoding_speed),
-            effort=int(self.effort),
-            use_container=True,
-            use_original_profile=True,
+        enc: pillow_jxl.Encoder = get_jxl_encoder(
+            img.mode,
+            self.quality,
+            int(self.effort),
+            int(self.decoding_speed),
+            self.num_threads,
         )
 
-        exif: bytes | None = img.info.get("exif", img.getexif().tobytes())
+        # getexif() is only used if EXIF isn't in info, because it parses the
+        # data again. It's empty if the image doesn't have EXIF data.
+        info: dict[str, Any] = img.info
+        exif: bytes | None = info.get("exif")
+        if exif is None:
+            exif_data: Image.Exif = img.getexif()
+            exif = exif_data.tobytes() if exif_data else None
         if exif and exif.startswith(b"Exif\x00\x00"):
             exif = exif[6:]
 
+        buf_data: bytes
         if self.jpegtran:
             with view_manager(in_buffer) as view:
-                buf_data = subprocess.run(
-                    ("jpegtran", "-copy", "all"),
-                    input=view,
-                    capture_output=True,
-                    check=True,
-                ).stdout
+                buf_data = run_program((find_program("jpegtran"), "-copy", "all"), view)
         else:
+            # The encoder only accepts bytes. getvalue() doesn't copy the data
+            # while the buffer has no exported views, so it must be called
+            # after view_manager releases them.
             buf_data = in_buffer.getvalue()
         in_buffer.close()
 
@@ -693,8 +878,8 @@ class JpegXLConverter(BaseConverter):
             img.height,
             jpeg_encode=True,
             exif=exif,
-            jumb=img.info.get("jumb"),
-            xmp=img.info.get("xmp"),
+            jumb=info.get("jumb"),
+            xmp=info.get("xmp"),
         )
         return jxl
 
@@ -708,6 +893,7 @@ class JpegXLConverter(BaseConverter):
                 quality=self.quality,
                 decoding_speed=self.decoding_speed,
                 effort=self.effort,
+                num_threads=self.num_threads,
                 exif=info.get("exif"),
                 jumb=info.get("jumb"),
                 xmp=info.get("xmp"),
@@ -734,7 +920,7 @@ class JpegXLConverter(BaseConverter):
                 in_buffer is an image.
         """
         img: Image.Image
-        with Image.open(in_buffer) as img:
+        with open_image(in_buffer) as img:
             if img.format == "JPEG" and img.mode in {"RGB", "L"}:
                 return self._jpg_to_jxl(in_buffer, img)
 
@@ -763,11 +949,12 @@ class JpegXLConverter(BaseConverter):
 class PngConverter(BaseConverter):
     """Converter to PNG images."""
 
+    __slots__ = ("optimize",)
     format = ImageFormat.PNG
     pil_format = "PNG"
     extension = ".png"
     options = {"optimize"}
-    quality: int = PNG_DEFAULT
+    quality: int
     optimize: bool
 
     def __init__(self, quality: int = PNG_DEFAULT, *, optimize: bool = False):
@@ -837,13 +1024,26 @@ class PngConverter(BaseConverter):
                 in_buffer is an image.
         """
         img: Image.Image
-        with Image.open(in_buffer) as img:
+        with open_image(in_buffer) as img:
             info: dict[str, Any] = img.info
             if img.mode in {"1", "L", "P"}:
                 return self.save(img, info)
 
             img2: Image.Image
-            if img.getcolors():
+            if (
+                not info.get("icc_profile")
+                and not img.has_transparency_data
+                and is_grayscale(img)
+            ):
+                # Scanned pages are often gray images stored as RGB, and a
+                # single channel is compressed faster and into less space.
+                # Pages with an ICC profile aren't converted, because the
+                # profile is for RGB images and it's invalid in an L image.
+                # Neither are pages with a transparent color, because Pillow
+                # would turn it into a gray level that may be in the page.
+                img2 = img.convert("L")
+
+            elif fits_in_palette(img):
                 img2 = img.convert("P")
 
             elif img.mode != "RGB" and not img.has_transparency_data:
@@ -857,3 +1057,11 @@ class PngConverter(BaseConverter):
 
         with img2:
             return self.save(img2, info)
+
+
+CONVERTERS: Final[dict[ImageFormat, type[BaseConverter]]] = {
+    ImageFormat.JPEG: JpegConverter,
+    ImageFormat.JPEGLI: JpegliConverter,
+    ImageFormat.JPEGXL: JpegXLConverter,
+    ImageFormat.PNG: PngConverter,
+}
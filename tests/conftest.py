@@ -19,9 +19,52 @@
 from pathlib import Path
 
 import pytest
+from PIL import features
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+class ImageCache(dict[str, bytes]):
+    """Dictionary that reads the files in the data folder when needed."""
+
+    def __missing__(self, name):
+        """Reads the file and stores its data."""
+        data = self[name] = (DATA_DIR / name).read_bytes()
+        return data
+
+
+def pytest_addoption(parser):
+    """Adds the --runslow option."""
+    parser.addoption("--runslow", action="store_true", help="run slow tests")
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skips tests marked as slow unless --runslow is used."""
+    if config.getoption("--runslow"):
+        return
+
+    skip_slow = pytest.mark.skip(reason="needs --runslow to run")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
+
+
+def pytest_report_header():
+    """Shows if Pillow uses libjpeg-turbo, which makes JPEG tests faster."""
+    version = features.version_feature("libjpeg_turbo")
+    return f"libjpeg-turbo: {version or 'not available'}"
 
 
 @pytest.fixture
 def test_data():
     """Returns the location of the folder where tests' data are stored."""
-    return Path(__file__).parent / "data"
+    return DATA_DIR
+
+
+@pytest.fixture(scope="session")
+def test_image_bytes():
+    """Returns the data of the files in the data folder.
+
+    Each file is read once per session, and it's shared by all tests.
+    """
+    return ImageCache()
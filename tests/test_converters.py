@@ -18,17 +18,53 @@
 
 # ruff: noqa: S101
 
+import pickle
+import shutil
+import subprocess
 from io import BytesIO
-from itertools import chain, product
+from itertools import chain, combinations, product
 
 import pytest
-from PIL import Image
+from PIL import Image, ImageCms, JpegImagePlugin
 
 from cb2cbz import converters
 
 BOOLS = (("true", True), ("1", True), ("false", False), ("0", False))
 
 
+def all_pairs(*values, valid=None):
+    """Returns combinations of the values that include all their pairs.
+
+    Each value of a parameter appears at least once with each value of
+    the other parameters, which needs far fewer combinations than their
+    product. They're chosen greedily from the product, skipping the ones
+    where valid returns False.
+    """
+    candidates = [comb for comb in product(*values) if valid is None or valid(comb)]
+
+    def pairs(comb):
+        return {
+            ((i, comb[i]), (j, comb[j])) for i, j in combinations(range(len(comb)), 2)
+        }
+
+    uncovered = set().union(*map(pairs, candidates))
+    found = []
+    while uncovered:
+        best = max(candidates, key=lambda comb: len(pairs(comb) & uncovered))
+        uncovered -= pairs(best)
+        found.append(best)
+    return found
+
+
+def test_all_pairs():
+    """Test that all_pairs covers every pair of values."""
+    values = ((1, 2, 3), ("a", "b", "c"), (True, False), (None, 0))
+    found = all_pairs(*values)
+    assert len(found) < len(list(product(*values)))
+    for (i, first), (j, second) in combinations(enumerate(values), 2):
+        assert {(comb[i], comb[j]) for comb in found} == set(product(first, second))
+
+
 class TestJpegSubsamplingEnum:
     """Test that JpegSubsamplingEnum has the right values."""
 
@@ -182,29 +218,38 @@ class TestJpegConverter:
         with pytest.raises(ValueError, match='"test" is not a valid subsampling'):
             converters.JpegConverter.parse_options("subsampling=test")
 
-    def test_jpegconverter_parse_options_all(self):
+    @pytest.mark.parametrize(
+        ("optimize", "progressive", "keep_rgb", "subsampling"),
+        all_pairs(
+            (None, *BOOLS),
+            (None, *BOOLS),
+            (None, *BOOLS),
+            (None, *converters.JpegSubsamplingEnum),
+        ),
+    )
+    def test_jpegconverter_parse_options_all(
+        self, optimize, progressive, keep_rgb, subsampling
+    ):
         """Test JpegConverter.parse_options using all possible options."""
-        none_bools = (None, *BOOLS)
-        subsampling = (None, *converters.JpegSubsamplingEnum)
-        names = ("optimize", "progressive", "keep_rgb", "subsampling")
-        combinations = product(none_bools, none_bools, none_bools, subsampling)
-
-        for comb in combinations:
-            converter = converters.JpegConverter.parse_options(
-                ",".join(
-                    f"{names[i]}={j if i == 3 else j[0]}"  # noqa: PLR2004
-                    for i, j in enumerate(comb)
-                    if j is not None
-                )
-            )
-            if comb[0]:
-                assert converter.optimize == comb[0][1]
-            if comb[1]:
-                assert converter.progressive == comb[1][1]
-            if comb[2]:
-                assert converter.keep_rgb == comb[2][1]
-            if comb[3]:
-                assert converter.subsampling == comb[3]
+        bool_options = {
+            "optimize": optimize,
+            "progressive": progressive,
+            "keep_rgb": keep_rgb,
+        }
+        options = [
+            f"{name}={value[0]}"
+            for name, value in bool_options.items()
+            if value is not None
+        ]
+        if subsampling is not None:
+            options.append(f"subsampling={subsampling}")
+
+        converter = converters.JpegConverter.parse_options(",".join(options))
+        for name, value in bool_options.items():
+            if value is not None:
+                assert getattr(converter, name) == value[1]
+        if subsampling is not None:
+            assert converter.subsampling == subsampling
 
     @pytest.mark.slow
     @pytest.mark.parametrize(
@@ -223,11 +268,10 @@ class TestJpegConverter:
             ("cursed_p_alpha.tif", "RGB"),
         ],
     )
-    def test_jpegconverter_convert(self, test_data, img_path, mode):
+    def test_jpegconverter_convert(self, test_image_bytes, img_path, mode):
         """Test convert function using a JPEG from a BytesIO object."""
         converter = converters.JpegConverter()
-        with (test_data / img_path).open(mode="rb") as img_file:
-            data = BytesIO(img_file.read())
+        data = BytesIO(test_image_bytes[img_path])
 
         with data:
             result = converter.convert(data)
@@ -250,7 +294,7 @@ class TestJpegConverter:
     )
     def test_jpegconverter_convert_options(
         self,
-        test_data,
+        test_image_bytes,
         img_path,
         subsampling,
         optimize,
@@ -265,30 +309,48 @@ class TestJpegConverter:
             progressive=progressive,
         )
 
-        with (test_data / img_path).resolve().open(mode="rb") as img_file:
-            data = BytesIO(img_file.read())
+        data = BytesIO(test_image_bytes[img_path])
 
         with data:
             result = converter.convert(data)
             assert isinstance(result, bytes)
             assert result
 
+    @pytest.mark.parametrize(
+        ("subsampling", "sampling"),
+        [
+            (converters.JpegSubsamplingEnum.S444, 0),
+            (converters.JpegSubsamplingEnum.S422, 1),
+            (converters.JpegSubsamplingEnum.S420, 2),
+        ],
+    )
+    def test_jpegconverter_convert_subsampling(self, test_data, subsampling, sampling):
+        """Test that the subsampling option is used by the encoder."""
+        converter = converters.JpegConverter(subsampling=subsampling)
+        data = BytesIO((test_data / "2864_compact_graphs.png").read_bytes())
+
+        with data:
+            result = converter.convert(data)
+        with BytesIO(result) as result_io, Image.open(result_io) as result_img:
+            assert JpegImagePlugin.get_sampling(result_img) == sampling
+
     @pytest.mark.parametrize(
         ("progressive", "dpi", "icc_profile", "exif", "comment"),
-        list(
-            product(
-                (0, 1, 2),
-                ((1000, 500), None),
-                (b"hello", None),
-                (b"world", None),
-                ("how are you?", None),
-            )
-        ),
+        [
+            pytest.param(0, (1000, 500), b"hello", b"world", "how are you?", id="all"),
+            pytest.param(1, (1000, 500), b"hello", b"world", "how are you?", id="p1"),
+            pytest.param(2, (1000, 500), b"hello", b"world", "how are you?", id="p2"),
+            pytest.param(0, None, None, None, None, id="none"),
+            pytest.param(0, None, b"hello", b"world", "how are you?", id="no-dpi"),
+            pytest.param(0, (1000, 500), None, b"world", "how are you?", id="no-icc"),
+            pytest.param(0, (1000, 500), b"hello", None, "how are you?", id="no-exif"),
+            pytest.param(0, (1000, 500), b"hello", b"world", None, id="no-comment"),
+        ],
     )
     def test_jpegconverter_get_metadata(
         self, progressive, dpi, icc_profile, exif, comment
     ):
-        """Test JpegConverter.get_metadata with all possible args."""
+        """Test JpegConverter.get_metadata with each key set and dropped."""
         keys = {"dpi", "icc_profile", "exif", "comment", "progressive"}
         info = {
             "test": "testing",
@@ -345,17 +407,17 @@ class TestJpegliConverter:
         assert converter.std_quant == std_quant
         assert converter.fixed_code == fixed_code
 
-    def test_jpegliconverter_init_valid_quality(self):
+    @pytest.mark.parametrize("quality", list(converters.JPEG_RANGE))
+    def test_jpegliconverter_init_valid_quality(self, quality):
         """Test JpegliConverter.__init__ with quality arg."""
-        for i in converters.JPEG_RANGE:
-            converter = converters.JpegliConverter(quality=i)
-            assert converter.quality == i
+        converter = converters.JpegliConverter(quality=quality)
+        assert converter.quality == quality
 
-    def test_jpegliconverter_init_valid_progressive(self):
+    @pytest.mark.parametrize("progressive", [0, 1, 2])
+    def test_jpegliconverter_init_valid_progressive(self, progressive):
         """Test JpegliConverter.__init__ with progressive arg."""
-        for i in (0, 1, 2):
-            converter = converters.JpegliConverter(progressive=i)
-            assert converter.progressive == i
+        converter = converters.JpegliConverter(progressive=progressive)
+        assert converter.progressive == progressive
 
     @pytest.mark.parametrize("value", tuple(converters.JpegliSubsamplingEnum))
     def test_jpegliconverter_init_valid_subsampling(self, value):
@@ -409,13 +471,17 @@ class TestJpegliConverter:
                 progressive=converters.JpegliProgressiveEnum.TWO, fixed_code=True
             )
 
-    def test_jpegliconverter_parse_options_valid_progressive_numbers(self):
+    @pytest.mark.parametrize("progressive", [0, 1, 2])
+    def test_jpegliconverter_parse_options_valid_progressive_numbers(self, progressive):
         """Test JpegliConverter.parse_options with numbers in progressive."""
-        for i in (0, 1, 2):
-            converter = converters.JpegliConverter.parse_options(f"progressive={i}")
-            assert converter.progressive == i
+        converter = converters.JpegliConverter.parse_options(
+            f"progressive={progressive}"
+        )
+        assert converter.progressive == progressive
 
-    @pytest.mark.parametrize(("value", "num"), [("true", 2), ("false", 0)])
+    @pytest.mark.parametrize(
+        ("value", "num"), [("true", 2), ("false", 0), ("TRUE", 2), ("False", 0)]
+    )
     def test_jpegliconverter_parse_options_valid_progressive_bools(self, value, num):
         """Test JpegliConverter.parse_options with booleans in progressive."""
         converter = converters.JpegliConverter.parse_options(f"progressive={value}")
@@ -462,7 +528,7 @@ class TestJpegliConverter:
         converter = converters.JpegliConverter.parse_options(f"std_quant={value}")
         assert converter.std_quant is boolean
 
-    @pytest.mark.parametrize("value", [-1, 3])
+    @pytest.mark.parametrize("value", [-1, 3, "yes"])
     def test_jpegliconverter_parse_options_invalid_progressive_number(self, value):
         """Test parse_options with invalid numbers in progressive."""
         with pytest.raises(
@@ -504,11 +570,10 @@ class TestJpegliConverter:
             ("cursed_p_alpha.tif", "RGB"),
         ],
     )
-    def test_jpegliconverter_convert(self, test_data, img_path, mode):
+    def test_jpegliconverter_convert(self, test_image_bytes, img_path, mode):
         """Test convert function using a JPEG from a BytesIO object."""
         converter = converters.JpegliConverter()
-        with (test_data / img_path).open(mode="rb") as img_file:
-            data = BytesIO(img_file.read())
+        data = BytesIO(test_image_bytes[img_path])
 
         with data:
             result = converter.convert(data)
@@ -528,23 +593,21 @@ class TestJpegliConverter:
             "std_quant",
             "fixed_code",
         ),
-        list(
-            filter(
-                lambda x: not (x[5] and x[0] != converters.JpegliProgressiveEnum.ZERO),
-                product(
-                    tuple(converters.JpegliProgressiveEnum),
-                    (*converters.JpegliSubsamplingEnum, None),
-                    (True, False),
-                    (True, False),
-                    (True, False),
-                    (True, False),
-                ),
-            )
+        all_pairs(
+            tuple(converters.JpegliProgressiveEnum),
+            (*converters.JpegliSubsamplingEnum, None),
+            (True, False),
+            (True, False),
+            (True, False),
+            (True, False),
+            valid=lambda x: (
+                not (x[5] and x[0] != converters.JpegliProgressiveEnum.ZERO)
+            ),
         ),
     )
     def test_jpegliconverter_convert_options(  # noqa: PLR0913
         self,
-        test_data,
+        test_image_bytes,
         progressive,
         subsampling,
         xyb,
@@ -562,10 +625,7 @@ class TestJpegliConverter:
             fixed_code=fixed_code,
         )
 
-        with (
-            (test_data / "2955_pole_vault_p.png").resolve().open(mode="rb") as img_file
-        ):
-            data = BytesIO(img_file.read())
+        data = BytesIO(test_image_bytes["2955_pole_vault_p.png"])
 
         with data:
             result = converter.convert(data)
@@ -588,6 +648,18 @@ class TestJpegXLConverter:
         assert converter.effort == effort
         assert converter.decoding_speed == decoding_speed
 
+    def test_jpegxlconverter_init_num_threads(self):
+        """Test JpegXLConverter.__init__ with num_threads."""
+        num_threads = 2
+        converter = converters.JpegXLConverter(num_threads=num_threads)
+        assert converter.num_threads == num_threads
+
+    def test_get_jxl_encoder(self):
+        """Test that encoders with the same settings are reused."""
+        encoder = converters.get_jxl_encoder("RGB", 90, 7, 0, -1)
+        assert converters.get_jxl_encoder("RGB", 90, 7, 0, -1) is encoder
+        assert converters.get_jxl_encoder("L", 90, 7, 0, -1) is not encoder
+
     def test_jpegxlconverter_init_invalid_quality(self):
         """Test JpegXLConverter.__init__ using invalid quality values."""
         for i in (-1, 101):
@@ -596,29 +668,27 @@ class TestJpegXLConverter:
             ):
                 converters.JpegXLConverter(quality=i)
 
-    def test_jpegxlconverter_parse_options_effort(self):
+    @pytest.mark.parametrize("num", list(converters.JpegXLEffortEnum))
+    def test_jpegxlconverter_parse_options_effort(self, num):
         """Test valid values for effort option."""
-        for num in converters.JpegXLEffortEnum:
-            converter = converters.JpegXLConverter.parse_options(f"effort={num}")
-            assert isinstance(converter, converters.JpegXLConverter)
-            assert converter.effort == num
+        converter = converters.JpegXLConverter.parse_options(f"effort={num}")
+        assert isinstance(converter, converters.JpegXLConverter)
+        assert converter.effort == num
 
-    def test_jpegxlconverter_parse_options_invalid_effort(self):
+    @pytest.mark.parametrize("num", list(chain(range(-10, 1), range(11, 21))))
+    def test_jpegxlconverter_parse_options_invalid_effort(self, num):
         """Test invalid values for effort option."""
-        for num in chain(range(-10, 1), range(11, 21)):
-            with pytest.raises(
-                ValueError, match="effort value must be an integer between 1 and 10"
-            ):
-                converters.JpegXLConverter.parse_options(f"effort={num}")
+        with pytest.raises(
+            ValueError, match="effort value must be an integer between 1 and 10"
+        ):
+            converters.JpegXLConverter.parse_options(f"effort={num}")
 
-    def test_jpegxlconverter_parse_options_decoding_speed(self):
+    @pytest.mark.parametrize("num", list(converters.JpegXLDecodingSpeedEnum))
+    def test_jpegxlconverter_parse_options_decoding_speed(self, num):
         """Test valid values for decoding_speed option."""
-        for num in converters.JpegXLDecodingSpeedEnum:
-            converter = converters.JpegXLConverter.parse_options(
-                f"decoding_speed={num}"
-            )
-            assert isinstance(converter, converters.JpegXLConverter)
-            assert converter.decoding_speed == num
+        converter = converters.JpegXLConverter.parse_options(f"decoding_speed={num}")
+        assert isinstance(converter, converters.JpegXLConverter)
+        assert converter.decoding_speed == num
 
     @pytest.mark.parametrize(("value", "boolean"), BOOLS)
     def test_jpegxlconverter_parse_options_jpegtran(self, value, boolean):
@@ -626,14 +696,14 @@ class TestJpegXLConverter:
         converter = converters.JpegXLConverter.parse_options(f"jpegtran={value}")
         assert converter.jpegtran is boolean
 
-    def test_jpegxlconverter_parse_options_invalid_decoding_speed(self):
+    @pytest.mark.parametrize("num", [-1, 5])
+    def test_jpegxlconverter_parse_options_invalid_decoding_speed(self, num):
         """Test invalid values for decoding_speed option."""
-        for num in (-1, 5):
-            with pytest.raises(
-                ValueError,
-                match="decoding_speed value must be an integer between 0 and 4",
-            ):
-                converters.JpegXLConverter.parse_options(f"decoding_speed={num}")
+        with pytest.raises(
+            ValueError,
+            match="decoding_speed value must be an integer between 0 and 4",
+        ):
+            converters.JpegXLConverter.parse_options(f"decoding_speed={num}")
 
     def test_jpegxlconverter_invalid_parse_options(self):
         """Test parse_options methods using invalid options."""
@@ -662,11 +732,12 @@ class TestJpegXLConverter:
             ("cursed_p_alpha.tif", "RGBA"),
         ],
     )
-    def test_jpegxlconverter_convert(self, test_data, img_path, mode):
+    def test_jpegxlconverter_convert(self, test_image_bytes, img_path, mode):
         """Test convert function using images from BytesIO objects."""
-        converter = converters.JpegXLConverter()
-        with (test_data / img_path).open(mode="rb") as img_file:
-            data = BytesIO(img_file.read())
+        converter = converters.JpegXLConverter(
+            effort=converters.JpegXLEffortEnum.LIGHTNING
+        )
+        data = BytesIO(test_image_bytes[img_path])
 
         with data:
             result = converter.convert(data)
@@ -682,11 +753,12 @@ class TestJpegXLConverter:
             ("2864_compact_graphs_rgb.jpg", "RGB"),
         ],
     )
-    def test_jpegxlconverter_convert_jpeg(self, test_data, img_path, mode):
+    def test_jpegxlconverter_convert_jpeg(self, test_image_bytes, img_path, mode):
         """Test convert function using JPEG files."""
-        converter = converters.JpegXLConverter()
-        with (test_data / img_path).open(mode="rb") as img_file:
-            data = BytesIO(img_file.read())
+        converter = converters.JpegXLConverter(
+            effort=converters.JpegXLEffortEnum.LIGHTNING
+        )
+        data = BytesIO(test_image_bytes[img_path])
 
         with data:
             result = converter.convert(data)
@@ -696,31 +768,71 @@ class TestJpegXLConverter:
             assert img.format == "JXL"
             assert img.mode == mode, f"{img.mode} != {mode}"
 
+    def test_jpegxlconverter_convert_jpeg_no_copy(self, test_data, monkeypatch):
+        """Test that JPEG data is passed to the encoder without a copy."""
+        data = (test_data / "2864_compact_graphs_rgb.jpg").read_bytes()
+        received = []
+
+        def encoder(buf_data, *args, **kwargs):  # noqa: ARG001
+            received.append(buf_data)
+            return b""
+
+        monkeypatch.setattr(
+            converters,
+            "get_jxl_encoder",
+            lambda *args: encoder,  # noqa: ARG005
+        )
+        converters.JpegXLConverter().convert(BytesIO(data))
+        assert received[0] is data
+
+    @pytest.mark.parametrize("has_exif", [True, False])
+    def test_jpegxlconverter_convert_jpeg_exif(self, monkeypatch, has_exif):
+        """Test that EXIF is only passed to the encoder if the JPEG has it."""
+        received = {}
+
+        def encoder(*args, **kwargs):  # noqa: ARG001
+            received.update(kwargs)
+            return b""
+
+        monkeypatch.setattr(
+            converters,
+            "get_jxl_encoder",
+            lambda *args: encoder,  # noqa: ARG005
+        )
+        exif = Image.Exif()
+        exif[0x010F] = "cb2cbz"
+
+        with Image.new("RGB", (8, 8)) as img, BytesIO() as data:
+            img.save(data, format="JPEG", **({"exif": exif} if has_exif else {}))
+            converters.JpegXLConverter().convert(data)
+
+        if has_exif:
+            assert received["exif"] == exif.tobytes()[6:]
+        else:
+            assert received["exif"] is None
+
     @pytest.mark.slow
     @pytest.mark.parametrize(
         ("img", "effort", "decoding_speed", "jpegtran"),
-        list(
-            product(
-                (
-                    ("2864_compact_graphs_rgb.jpg", "JPEG"),
-                    ("2955_pole_vault_p.png", "PNG"),
-                ),
-                converters.JpegXLEffortEnum,
-                converters.JpegXLDecodingSpeedEnum,
-                (True, False),
-            )
+        all_pairs(
+            (
+                ("2864_compact_graphs_rgb.jpg", "JPEG"),
+                ("2955_pole_vault_p.png", "PNG"),
+            ),
+            tuple(converters.JpegXLEffortEnum),
+            tuple(converters.JpegXLDecodingSpeedEnum),
+            (True, False),
         ),
     )
     def test_jpegxlconverter_convert_options(
-        self, test_data, img, effort, decoding_speed, jpegtran
+        self, test_image_bytes, img, effort, decoding_speed, jpegtran
     ):
         """Test JpegliConverter.convert with all possible arguments."""
         converter = converters.JpegXLConverter(
             effort=effort, decoding_speed=decoding_speed, jpegtran=jpegtran
         )
 
-        with (test_data / img[0]).resolve().open(mode="rb") as img_file:
-            data = BytesIO(img_file.read())
+        data = BytesIO(test_image_bytes[img[0]])
 
         with data:
             result = converter.convert(data)
@@ -780,11 +892,10 @@ class TestPngConverter:
             ("cursed_p_alpha.tif", "RGBA"),
         ],
     )
-    def test_pngconverter_convert(self, test_data, img_path, mode):
+    def test_pngconverter_convert(self, test_image_bytes, img_path, mode):
         """Test convert function using image from BytesIO objects."""
         converter = converters.PngConverter()
-        with (test_data / img_path).open(mode="rb") as img_file:
-            data = BytesIO(img_file.read())
+        data = BytesIO(test_image_bytes[img_path])
 
         with data:
             result = converter.convert(data)
@@ -792,6 +903,161 @@ class TestPngConverter:
         with BytesIO(result) as result_io, Image.open(result_io) as result_img:
             assert result_img.mode == mode, f"{result_img.mode} != {mode}"
 
+    def test_pngconverter_convert_grayscale(self):
+        """Test that gray RGB images are stored as L."""
+        with Image.new("RGB", (64, 64), "white") as img, BytesIO() as data:
+            img.paste((50, 50, 50), (0, 0, 32, 32))
+            img.save(data, format="PNG")
+            result = converters.PngConverter().convert(data)
+
+        with BytesIO(result) as result_io, Image.open(result_io) as result_img:
+            assert result_img.mode == "L"
+
+    def test_pngconverter_convert_grayscale_icc_profile(self):
+        """Test that gray RGB images with an ICC profile aren't stored as L."""
+        srgb = ImageCms.createProfile("sRGB")
+        icc_profile = ImageCms.ImageCmsProfile(srgb).tobytes()
+        with Image.new("RGB", (64, 64), "white") as img, BytesIO() as data:
+            img.paste((50, 50, 50), (0, 0, 32, 32))
+            img.save(data, format="PNG", icc_profile=icc_profile)
+            result = converters.PngConverter().convert(data)
+
+        with BytesIO(result) as result_io, Image.open(result_io) as result_img:
+            assert result_img.mode == "P"
+            assert result_img.info["icc_profile"] == icc_profile
+            profile = ImageCms.ImageCmsProfile(BytesIO(icc_profile))
+            transform = ImageCms.buildTransform(profile, srgb, "RGB", "RGB")
+            with result_img.convert("RGB") as rgb_img:
+                ImageCms.applyTransform(rgb_img, transform).close()
+
+    def test_pngconverter_convert_grayscale_transparency(self):
+        """Test that gray RGB images with a transparent color stay opaque."""
+        with Image.new("RGB", (64, 64), (122, 122, 122)) as img, BytesIO() as data:
+            img.save(data, format="PNG", transparency=(10, 200, 10))
+            result = converters.PngConverter().convert(data)
+
+        with BytesIO(result) as result_io, Image.open(result_io) as result_img:
+            assert result_img.mode != "L"
+            with result_img.convert("RGBA") as rgba_img:
+                assert rgba_img.getextrema()[3] == (255, 255)
+
+
+class TestRemoveAlpha:
+    """Test remove_alpha function."""
+
+    @pytest.mark.parametrize(
+        ("mode", "color", "output_mode", "expected"),
+        [
+            ("RGBA", (0, 0, 0, 0), "RGB", (255, 255, 255)),
+            ("RGBA", (0, 0, 0, 255), "RGB", (0, 0, 0)),
+            ("RGBA", (0, 100, 200, 128), "RGB", (127, 177, 227)),
+            ("LA", (0, 0), "L", 255),
+            ("LA", (100, 255), "L", 100),
+            ("PA", (0, 0), "RGB", (255, 255, 255)),
+        ],
+    )
+    def test_remove_alpha(self, mode, color, output_mode, expected):
+        """Test that transparent pixels are blended with white."""
+        img = Image.new(mode, (4, 4), color)
+        with converters.remove_alpha(img) as result:
+            assert result.mode == output_mode
+            assert result.getpixel((0, 0)) == expected
+
+
+class TestFitsInPalette:
+    """Test fits_in_palette function."""
+
+    def test_fits_in_palette(self):
+        """Test an image with less than 256 colors."""
+        with Image.new("RGB", (256, 256), "white") as img:
+            img.paste((255, 0, 0), (0, 0, 100, 100))
+            assert converters.fits_in_palette(img)
+
+    def test_fits_in_palette_many_colors(self):
+        """Test an image with a lot of colors in every pixel."""
+        with Image.merge(
+            "RGB", [Image.effect_noise((256, 256), 100) for _ in range(3)]
+        ) as img:
+            assert not converters.fits_in_palette(img)
+
+    def test_fits_in_palette_sample_missed(self):
+        """Test an image whose extra colors are not in the sample."""
+        with Image.new("RGB", (256, 256), "white") as img:
+            for i in range(300):
+                img.putpixel((i % 255 + 1, i // 255 * 2 + 1), (i % 256, i // 256, 0))
+            assert not converters.fits_in_palette(img)
+
+
+class TestIsGrayscale:
+    """Test is_grayscale function."""
+
+    @pytest.mark.parametrize(
+        ("mode", "color", "expected"),
+        [
+            ("RGB", (100, 100, 100), True),
+            ("RGB", (100, 100, 101), False),
+            ("L", 100, False),
+            ("RGBA", (100, 100, 100, 255), False),
+        ],
+    )
+    def test_is_grayscale(self, mode, color, expected):
+        """Test images with a single color."""
+        with Image.new(mode, (64, 64), color) as img:
+            assert converters.is_grayscale(img) is expected
+
+    def test_is_grayscale_sample_missed(self):
+        """Test an image whose only color pixel is not in the sample."""
+        with Image.new("RGB", (64, 64), (100, 100, 100)) as img:
+            img.putpixel((1, 1), (255, 0, 0))
+            assert not converters.is_grayscale(img)
+
+
+class TestFindProgram:
+    """Test find_program function."""
+
+    def test_find_program(self):
+        """Test that it returns the full path to a program."""
+        assert converters.find_program("sh") == shutil.which("sh")
+
+    def test_find_program_not_found(self):
+        """Test that it returns the name if the program isn't found."""
+        name = "cb2cbz-test-not-found"
+        assert converters.find_program(name) == name
+
+
+class TestRunProgram:
+    """Test run_program function."""
+
+    def test_run_program(self):
+        """Test that it returns what the program writes to stdout."""
+        data = bytes(range(256)) * 4096
+        assert converters.run_program(("cat",), memoryview(data)) == data
+
+    def test_run_program_error(self):
+        """Test that it raises an error that includes stdout and stderr."""
+        with pytest.raises(subprocess.CalledProcessError) as exc_info:
+            converters.run_program(
+                ("sh", "-c", "cat; head -c 200000 /dev/zero >&2; exit 3"),
+                memoryview(b"test"),
+            )
+
+        assert exc_info.value.returncode == 3  # noqa: PLR2004
+        assert exc_info.value.output == b"test"
+        assert exc_info.value.stderr == bytes(200000)
+
+    def test_run_program_error_without_stderr(self, monkeypatch):
+        """Test that the error is raised if stderr couldn't be read."""
+        monkeypatch.setattr(converters, "read_output", lambda *_: None)
+        with pytest.raises(subprocess.CalledProcessError) as exc_info:
+            converters.run_program(("sh", "-c", "exit 3"), memoryview(b""))
+
+        assert exc_info.value.returncode == 3  # noqa: PLR2004
+        assert exc_info.value.stderr == b""
+
+    def test_run_program_unread_input(self):
+        """Test that it works if the program doesn't read its input."""
+        assert converters.run_program(("true",), memoryview(bytes(1 << 20))) == b""
+
 
 class TestParseStrBool:
     """Test parse_str_bool function."""
@@ -816,3 +1082,22 @@ class TestParseStrBool:
             ValueError, match='test value must be "1", "0", "true" or "false"'
         ):
             converters.parse_str_bool("testing", "test")
+
+
+@pytest.mark.parametrize(
+    "format_", [i for i in converters.ImageFormat if i != "no-change"]
+)
+def test_converters_table(format_):
+    """Test that each image format has a converter for it."""
+    assert converters.CONVERTERS[format_].format == format_
+
+
+@pytest.mark.parametrize("converter", list(converters.CONVERTERS.values()))
+def test_converters_slots(converter):
+    """Test that converters use slots and can be sent to other processes."""
+    instance = converter()
+    assert not hasattr(instance, "__dict__")
+
+    copied = pickle.loads(pickle.dumps(instance))  # noqa: S301
+    for name in (*converters.BaseConverter.__slots__, *converter.__slots__):
+        assert getattr(copied, name) == getattr(instance, name)
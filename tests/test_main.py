@@ -18,9 +18,15 @@
 
 # ruff: noqa: S101
 
+import os
+import pickle
+import stat
+import subprocess
 import sys
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import nullcontext
-from itertools import chain, product
+from itertools import product
 from pathlib import Path, PurePath
 from subprocess import CalledProcessError
 from types import NoneType
@@ -40,6 +46,19 @@ CONVERTERS = (
 )
 
 
+def test_lazy_imports():
+    """Test that modules only used for converting aren't imported at start."""
+    code = (
+        "import sys, cb2cbz.__main__; "
+        "print(sorted({'pillow_jxl', 'multiprocessing', 'concurrent.futures'} "
+        "& sys.modules.keys()))"
+    )
+    result = subprocess.run(  # noqa: S603
+        (sys.executable, "-c", code), capture_output=True, check=True, text=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
 @pytest.mark.parametrize(
     "converter",
     [
@@ -74,20 +93,21 @@ class TestErrormsg:
         captured = capsys.readouterr()
         assert captured.err.strip() == f"{PurePath(sys.argv[0]).name}: Warning: test"
 
-    def test_errormsg_error(self, capsys):
+    @pytest.mark.parametrize("code", [1, 127, 255])
+    def test_errormsg_error(self, capsys, code):
         """Test errormsg errors."""
-        for i in range(1, 256):
-            with pytest.raises(SystemExit):
-                __main__.errormsg("test", i)
+        with pytest.raises(SystemExit) as exc_info:
+            __main__.errormsg("test", code)
 
-            captured = capsys.readouterr()
-            assert captured.err.strip() == f"{PurePath(sys.argv[0]).name}: Error: test"
+        assert exc_info.value.code == code
+        captured = capsys.readouterr()
+        assert captured.err.strip() == f"{PurePath(sys.argv[0]).name}: Error: test"
 
-    def test_errormsg_invalid_code(self):
+    @pytest.mark.parametrize("code", [-256, -1, 256, 511])
+    def test_errormsg_invalid_code(self, code):
         """Test errormsg using invalid numbers for code arg."""
-        for i in chain(range(-256, 0), range(256, 512)):
-            with pytest.raises(ValueError, match="code is not between 0 and 255"):
-                __main__.errormsg("test", i)
+        with pytest.raises(ValueError, match="code is not between 0 and 255"):
+            __main__.errormsg("test", code)
 
 
 class TestParseParams:
@@ -125,7 +145,6 @@ class TestParseParams:
         """Test -f argument."""
         params = __main__.parse_params(("-f", str(format_), "test.cbr"))
         assert isinstance(params, __main__.Parameters)
-        print(type(params.converter))
         assert isinstance(params.converter, converter)
 
     @pytest.mark.parametrize(("format_", "converter"), format_converters)
@@ -176,30 +195,59 @@ class TestParseParams:
         with pytest.raises(SystemExit):
             __main__.parse_params(("--format", "failtest", "test.cbr"))
 
-    def test_invalid_jpeg_quality(self):
+    @pytest.mark.parametrize("format_", ["jpeg", "jpegxl", "jpegli"])
+    @pytest.mark.parametrize("quality", [-100, -1, 101, 199])
+    def test_invalid_jpeg_quality(self, format_, quality):
         """Test if it exits because of an invalid quality for JPEG."""
-        for format_, quality in product(
-            ("jpeg", "jpegxl", "jpegli"), chain(range(-100, 0), range(101, 200))
-        ):
-            with pytest.raises(SystemExit):
-                __main__.parse_params(
-                    ("--format", format_, "--quality", str(quality), "test.cbr")
-                )
+        with pytest.raises(SystemExit):
+            __main__.parse_params(
+                ("--format", format_, "--quality", str(quality), "test.cbr")
+            )
 
-    def test_invalid_quality(self):
+    @pytest.mark.parametrize("quality", [-10, -1, 10, 19])
+    def test_invalid_quality(self, quality):
         """Test if it exits because of an invalid PNG quality."""
-        for i in chain(range(-10, 0), range(10, 20)):
-            with pytest.raises(SystemExit):
-                __main__.parse_params(
-                    ("--format", "png", "--quality", str(i), "test.cbr")
-                )
+        with pytest.raises(SystemExit):
+            __main__.parse_params(
+                ("--format", "png", "--quality", str(quality), "test.cbr")
+            )
+
+    @pytest.mark.parametrize("format_", ["jpeg", "no-change"])
+    def test_jobs(self, format_):
+        """Test --jobs argument."""
+        jobs = 3
+        params = __main__.parse_params(
+            ("--format", format_, "--jobs", str(jobs), "test.cbr")
+        )
+        assert params.jobs == jobs
+
+    def test_jobs_jpegxl_threads(self, monkeypatch):
+        """Test that JPEG XL encoder threads are split between processes."""
+        monkeypatch.setattr(__main__.os, "cpu_count", lambda: 8)
+        params1 = __main__.parse_params(("--format", "jpegxl", "-j", "1", "test.cbr"))
+        params2 = __main__.parse_params(("--format", "jpegxl", "-j", "3", "test.cbr"))
+        params3 = __main__.parse_params(("--format", "jpegxl", "-j", "16", "test.cbr"))
+        assert params1.converter.num_threads == -1
+        assert params2.converter.num_threads == 2  # noqa: PLR2004
+        assert params3.converter.num_threads == 1
+
+    @pytest.mark.parametrize("jobs", [-1, 0])
+    def test_invalid_jobs(self, jobs):
+        """Test if it exits because of an invalid number of jobs."""
+        with pytest.raises(SystemExit):
+            __main__.parse_params(("--jobs", str(jobs), "test.cbr"))
 
 
 class MockArchiveWrite:
     """A mock of :cls:`libarchive.write.ArchiveWrite`."""
 
-    def add_file_from_memory(*args, **kwargs):
-        """Does nothing."""
+    def __init__(self):
+        """Initializes the list of calls."""
+        self.calls = []
+
+    def add_file_from_memory(self, *args, **kwargs):
+        """Records the arguments of the call."""
+        self.calls.append((args, kwargs))
 
 
 class MockConverter(converters.BaseConverter):
@@ -225,20 +273,48 @@ class MockConverter(converters.BaseConverter):
         raise CalledProcessError(msg, "mytest", stderr=b"Test error")
 
 
+class UpperConverter(MockConverter):
+    """A mock of a converter that returns its input in upper case."""
+
+    def convert(self, in_buffer):
+        """Returns the data in upper case."""
+        return in_buffer.getvalue().upper()
+
+
+class MockExecutor:
+    """A mock of an executor that runs each task when it's asked to."""
+
+    def __init__(self):
+        """Initializes the list of submitted tasks."""
+        self.tasks = []
+
+    def submit(self, fn, *args):
+        """Stores the task and returns its future."""
+        future = Future()
+        self.tasks.append((future, fn, args))
+        return future
+
+    def run(self, index):
+        """Runs a task and sets the result of its future."""
+        future, fn, args = self.tasks[index]
+        future.set_result(fn(*args))
+
+
 class MockEntry:
     """A mock of an entry for doing a test."""
 
-    def __init__(self, pathname):
+    def __init__(self, pathname, data=b""):
         """Initializes the class."""
         self.pathname = pathname
+        self.data = data
         self.filetype = FileType.REGULAR_FILE
         self.perm = self.uid = self.gid = self.size = self.atime = self.mtime = 0
         self.ctime = self.birthtime = self.rdev = self.rdevmajor = self.rdevminor = 0
         self.uname = self.gname = ""
 
-    def get_blocks(self):
-        """Returns an empty bytes object."""
-        yield b""
+    def get_blocks(self, block_size=4096):  # noqa: ARG002
+        """Returns the data of the entry."""
+        yield self.data
 
 
 def test_mock_converter_parse_options():
@@ -246,24 +322,101 @@ def test_mock_converter_parse_options():
     assert isinstance(MockConverter.parse_options(("1", "2", "3")), MockConverter)
 
 
+def test_wrap_bulleted_text():
+    """Test that bulleted lines are indented after wrapping."""
+    text = "* jpeg:\n  - optimize: If true does an extra step"
+    assert __main__.wrap_bulleted_text(text, 20) == (
+        "* jpeg:\n  - optimize: If\n    true does an\n    extra step"
+    )
+    assert __main__.wrap_bulleted_text(text, 20) is __main__.wrap_bulleted_text(
+        text, 20
+    )
+
+
+def test_get_entry_attrs():
+    """Test that get_entry_attrs skips attributes that are None."""
+    entry = MockEntry("test")
+    entry.birthtime = entry.rdev = None
+    attrs = __main__.get_entry_attrs(entry)
+    assert attrs.keys() == set(__main__.ENTRY_ATTRS) - {"birthtime", "rdev"}
+    assert attrs["uname"] == ""
+    assert attrs["mtime"] == 0
+
+
+def test_read_entry():
+    """Test that read_entry joins all the blocks of an entry."""
+    entry = MockEntry("test")
+    entry.get_blocks = lambda: iter((b"ab", b"cd", b"e"))
+    assert __main__.read_entry(entry) == b"abcde"
+
+
+def test_read_entry_size():
+    """Test that read_entry reads the entry in a block of its size."""
+    entry = MockEntry("test")
+    entry.size = 5
+    block_sizes = []
+
+    def get_blocks(block_size=4096):
+        block_sizes.append(block_size)
+        yield b"abcde"
+
+    entry.get_blocks = get_blocks
+    assert __main__.read_entry(entry) == b"abcde"
+    assert block_sizes == [5]
+
+
+def test_read_entry_size_limit():
+    """Test that read_entry doesn't use blocks bigger than READ_BLOCK_SIZE."""
+    entry = MockEntry("test")
+    entry.size = 1 << 40
+    block_sizes = []
+
+    def get_blocks(block_size=4096):
+        block_sizes.append(block_size)
+        yield b"abcde"
+
+    entry.get_blocks = get_blocks
+    assert __main__.read_entry(entry) == b"abcde"
+    assert block_sizes == [__main__.READ_BLOCK_SIZE]
+
+
+class TestConvertImage:
+    """Tests for convert_image function."""
+
+    def test_convert_image(self, test_data):
+        """Test that the image is converted."""
+        data = (test_data / "2953_alien_theories.png").read_bytes()
+        result = __main__.convert_image(converters.JpegConverter(), data)
+        assert isinstance(result, bytes)
+        assert result.startswith(b"\xff\xd8")
+
+    def test_convert_image_unidentified(self):
+        """Test that it returns None if the data is not an image."""
+        assert __main__.convert_image(converters.JpegConverter(), b"test") is None
+
+    def test_convert_image_called_process_error(self):
+        """Test that stderr is kept when a subprocess fails."""
+        with pytest.raises(CalledProcessError) as exc_info:
+            __main__.convert_image(MockConverter(0), b"")
+
+        err = pickle.loads(pickle.dumps(exc_info.value))  # noqa: S301
+        assert err.stderr == b"Test error"
+
+
 class TestEntryStorer:
     """Tests for EntryStorer methods."""
 
     ext_and_converters = tuple(product((*CONVERTERS, None), EXTENSIONS))
 
-    @pytest.mark.slow
-    @pytest.mark.parametrize(("conv", "ext"), ext_and_converters)
-    def test_entrystorer_init(self, tmp_path, conv, ext):
+    @pytest.mark.parametrize("conv", [*CONVERTERS, None])
+    def test_entrystorer_init(self, conv):
         """Test EntryStorer.__init__ with multiple formats."""
-        out_path = tmp_path / f"test_{ext}.cbz"
         converter = None if conv is None else conv()
+        output_arc = MockArchiveWrite()
 
-        with file_writer(
-            str(out_path), "zip", options="compression=store"
-        ) as output_arc:
-            entry_storer = __main__.EntryStorer(output_arc, converter)
-            assert entry_storer.archive == output_arc
-            assert converter is None or isinstance(entry_storer.converter, conv)
+        entry_storer = __main__.EntryStorer(output_arc, converter)
+        assert entry_storer.archive is output_arc
+        assert converter is None or isinstance(entry_storer.converter, conv)
 
     @pytest.mark.slow
     @pytest.mark.parametrize(("conv", "ext"), ext_and_converters)
@@ -282,7 +435,6 @@ class TestEntryStorer:
         ):
             entry_storer = __main__.EntryStorer(output_arc, converter)
             for entry in input_arc:
-                print(entry)
                 if entry.isreg:
                     new_name = __main__.create_new_name(entry.pathname, converter)
                     files.add(new_name.strip("/"))
@@ -299,13 +451,110 @@ class TestEntryStorer:
                     )
                     files.add(entry.pathname.strip("/"))
 
-        found = set()
-        with file_reader(str(out_path)) as created_arc:
-            for entry in created_arc:
-                found.add(entry.pathname.strip("/"))
+        with zipfile.ZipFile(out_path) as created_zip:
+            found = {name.strip("/") for name in created_zip.namelist()}
 
         assert files == found, f"the difference between files an found {files ^ found}"
 
+    def test_entrystorer_save_entry_single_write(self):
+        """Test that entries are written with all their data at once."""
+        archive = MockArchiveWrite()
+        entry = MockEntry("test")
+        entry.get_blocks = lambda: iter((b"ab", b"cd"))
+        entry_storer = __main__.EntryStorer(archive, None)
+        entry_storer.save_entry(entry, "test")
+
+        assert len(archive.calls) == 1
+        assert archive.calls[0][0][:3] == ("test", 4, b"abcd")
+
+    def test_entrystorer_mtime(self, test_data):
+        """Test that converted entries use the same modification time."""
+        archive = MockArchiveWrite()
+        data = (test_data / "2953_alien_theories.png").read_bytes()
+        entry_storer = __main__.EntryStorer(
+            archive, converters.JpegConverter(), mtime=1234.5
+        )
+        for name in ("a", "b"):
+            entry = MockEntry(name)
+            entry.get_blocks = lambda: iter((data,))
+            entry_storer.save_entry(entry, f"{name}.jpg")
+
+        assert [kwargs["mtime"] for _, kwargs in archive.calls] == [1234.5, 1234.5]
+
+    def test_entrystorer_executor_order(self, capsys):
+        """Test that converted entries are stored in the order they came."""
+        archive = MockArchiveWrite()
+        executor = MockExecutor()
+        entry_storer = __main__.EntryStorer(archive, UpperConverter(0), executor, 4)
+        for name in ("a", "b", "c"):
+            entry_storer.save_entry(MockEntry(name, name.encode()), f"{name}.test")
+        assert archive.calls == []
+        assert capsys.readouterr().out == ""
+
+        for i in (2, 1, 0):
+            executor.run(i)
+        entry_storer.flush()
+
+        assert [args[:3] for args, _ in archive.calls] == [
+            ("a.test", 1, b"A"),
+            ("b.test", 1, b"B"),
+            ("c.test", 1, b"C"),
+        ]
+        assert not entry_storer.pending
+        assert capsys.readouterr().out == "a → a.test\nb → b.test\nc → c.test\n"
+
+    def test_entrystorer_executor_save_dir(self):
+        """Test that directories wait for the entries saved before them."""
+        archive = MockArchiveWrite()
+        executor = MockExecutor()
+        entry_storer = __main__.EntryStorer(archive, UpperConverter(0), executor, 4)
+        first_dir, second_dir = MockEntry("x/"), MockEntry("y/")
+        first_dir.filetype = second_dir.filetype = FileType.DIRECTORY
+
+        entry_storer.save_dir(first_dir)
+        assert [args[0] for args, _ in archive.calls] == ["x/"]
+
+        entry_storer.save_entry(MockEntry("x/a", b"a"), "x/a.test")
+        entry_storer.save_dir(second_dir)
+        assert [args[0] for args, _ in archive.calls] == ["x/"]
+
+        executor.run(0)
+        entry_storer.flush()
+        assert [args[0] for args, _ in archive.calls] == ["x/", "x/a.test", "y/"]
+
+    def test_entrystorer_executor_max_pending(self):
+        """Test that no more than max_pending entries wait at once."""
+        archive = MockArchiveWrite()
+        max_pending = 2
+        with ThreadPoolExecutor(1) as executor:
+            entry_storer = __main__.EntryStorer(
+                archive, UpperConverter(0), executor, max_pending
+            )
+            for i, name in enumerate(("a", "b", "c", "d")):
+                entry_storer.save_entry(MockEntry(name, name.encode()), name)
+                assert len(entry_storer.pending) < max_pending
+                assert len(archive.calls) == i
+
+            entry_storer.flush()
+
+        assert [args[2] for args, _ in archive.calls] == [b"A", b"B", b"C", b"D"]
+
+    def test_entrystorer_executor_called_process_error(self, capsys):
+        """Test the error message when a conversion in the executor fails."""
+        with ThreadPoolExecutor(1) as executor:
+            entry_storer = __main__.EntryStorer(
+                MockArchiveWrite(), MockConverter(0), executor, 2
+            )
+            entry_storer.save_entry(MockEntry("A test"), "test")
+            with pytest.raises(SystemExit):
+                entry_storer.flush()
+
+        captured = capsys.readouterr()
+        assert captured.err.strip() == (
+            f"{PurePath(sys.argv[0]).name}: Error: An error happened while "
+            'encoding "A test": Test error'
+        )
+
     def test_called_process_error_message(self, capsys):
         """Test if an error message is printed when a subprocess fails."""
         converter = MockConverter(0)
@@ -314,13 +563,108 @@ class TestEntryStorer:
             entry_storer.save_entry(MockEntry("A test"), "test")
 
         captured = capsys.readouterr()
-        print(captured)
         assert captured.err.strip() == (
             f"{PurePath(sys.argv[0]).name}: Error: An error happened while "
             'encoding "A test": Test error'
         )
 
 
+class TestArchiveReader:
+    """Tests for archive_reader function."""
+
+    @pytest.mark.parametrize("ext", EXTENSIONS)
+    def test_archive_reader(self, test_data, ext):
+        """Test that it reads the same entries as file_reader."""
+        in_path = test_data / f"xkcd.{ext}"
+        with file_reader(str(in_path)) as input_arc:
+            expected = [
+                (entry.pathname, b"".join(entry.get_blocks()) if entry.isfile else b"")
+                for entry in input_arc
+            ]
+
+        with __main__.archive_reader(in_path) as input_arc:
+            found = [
+                (entry.pathname, __main__.read_entry(entry) if entry.isfile else b"")
+                for entry in input_arc
+            ]
+
+        assert found == expected
+
+
+@pytest.mark.parametrize(
+    "name", ["found.cbz", "página_ñ.cbz", os.fsdecode(b"found_\xff.cbz")]
+)
+def test_archive_writer(tmp_path, name):
+    """Test that archive_writer creates the same file as file_writer."""
+    data = bytes(range(256)) * 8192
+    paths = (tmp_path / "expected.cbz", tmp_path / name)
+    with file_writer(str(paths[0]), "zip", options="compression=store") as arc:
+        arc.add_file_from_memory("a/b.png", len(data), data)
+    with __main__.archive_writer(paths[1]) as arc:
+        arc.add_file_from_memory("a/b.png", len(data), data)
+
+    assert paths[1].read_bytes() == paths[0].read_bytes()
+
+
+class TestStoredZipNames:
+    """Tests for stored_zip_names function."""
+
+    @staticmethod
+    def create_zip(path, compression=zipfile.ZIP_STORED, names=("a/b.png",)):
+        """Creates a ZIP file with a directory and the given files."""
+        with zipfile.ZipFile(path, "w", compression) as zip_file:
+            zip_file.mkdir("a")
+            for name in names:
+                zip_file.writestr(name, b"test")
+
+    @staticmethod
+    def add_symlink(path, name, target):
+        """Adds a symlink entry to a ZIP file."""
+        link = zipfile.ZipInfo(name)
+        link.external_attr = (stat.S_IFLNK | 0o777) << 16
+        with zipfile.ZipFile(path, "a") as zip_file:
+            zip_file.writestr(link, target)
+
+    def test_stored_zip_names(self, tmp_path):
+        """Test that it returns the files of a ZIP without compression."""
+        path = tmp_path / "test.cbz"
+        self.create_zip(path)
+        assert __main__.stored_zip_names(path) == ["a/b.png"]
+
+    def test_stored_zip_names_compressed(self, tmp_path):
+        """Test that it returns None if an entry is compressed."""
+        path = tmp_path / "test.cbz"
+        self.create_zip(path, zipfile.ZIP_DEFLATED)
+        assert __main__.stored_zip_names(path) is None
+
+    def test_stored_zip_names_duplicated(self, tmp_path):
+        """Test that it returns None if there are duplicated names."""
+        path = tmp_path / "test.cbz"
+        self.create_zip(path, names=("a/b.png", "a/b.png/"))
+        assert __main__.stored_zip_names(path) is None
+
+    def test_stored_zip_names_symlink(self, tmp_path):
+        """Test that it returns None if there is a symlink."""
+        path = tmp_path / "test.cbz"
+        self.create_zip(path)
+        self.add_symlink(path, "a/link.png", "b.png")
+        assert __main__.stored_zip_names(path) is None
+
+    def test_stored_zip_names_comment(self, tmp_path):
+        """Test that it returns None if the archive has a comment."""
+        path = tmp_path / "test.cbz"
+        self.create_zip(path)
+        with zipfile.ZipFile(path, "a") as zip_file:
+            zip_file.comment = b"test"
+
+        assert __main__.stored_zip_names(path) is None
+
+    @pytest.mark.parametrize("ext", ["cbt", "cb7", "cbr"])
+    def test_stored_zip_names_not_zip(self, test_data, ext):
+        """Test that it returns None if the file is not a ZIP file."""
+        assert __main__.stored_zip_names(test_data / f"xkcd.{ext}") is None
+
+
 class TestMain:
     """Tests for main() function."""
 
@@ -340,6 +684,55 @@ class TestMain:
         __main__.main(("--format", "no-change", str(in_path), out_path))
         assert in_path.exists()
 
+    def test_cb_to_cbz_no_change_copy(self, tmp_path, capsys):
+        """Test that a ZIP file without compression is copied."""
+        in_path = tmp_path / "test.zip"
+        out_path = tmp_path / "test.cbz"
+        TestStoredZipNames.create_zip(in_path)
+        __main__.main(("--format", "no-change", str(in_path), str(out_path)))
+
+        assert out_path.read_bytes() == in_path.read_bytes()
+        assert capsys.readouterr().out == "a/b.png → a/b.png\n"
+
+    def test_cb_to_cbz_no_change_symlink(self, tmp_path):
+        """Test that a ZIP file with a symlink is written again."""
+        in_path = tmp_path / "test.zip"
+        out_path = tmp_path / "test.cbz"
+        TestStoredZipNames.create_zip(in_path)
+        TestStoredZipNames.add_symlink(in_path, "a/link.png", "b.png")
+        __main__.main(("--format", "no-change", str(in_path), str(out_path)))
+
+        with zipfile.ZipFile(out_path) as out_zip:
+            assert {name.strip("/") for name in out_zip.namelist()} == {"a", "a/b.png"}
+
+    def test_cb_to_cbz_no_change_same_file(self, tmp_path):
+        """Test that a ZIP file is not copied to itself."""
+        path = tmp_path / "test.cbz"
+        TestStoredZipNames.create_zip(path)
+        assert not __main__.copy_stored_zip(path, path)
+
+    @pytest.mark.slow
+    @pytest.mark.parametrize("ext", EXTENSIONS)
+    def test_cb_to_cbz_jobs(self, test_data, tmp_path, ext):
+        """Test that converting with several processes keeps the order."""
+        in_path = test_data / f"xkcd.{ext}"
+        out_path = tmp_path / f"test_{ext}.cbz"
+        __main__.main(("--format", "png", "--jobs", "2", str(in_path), str(out_path)))
+
+        with file_reader(str(in_path)) as input_arc:
+            expected = [
+                __main__.create_new_name(
+                    entry.pathname,
+                    converters.PngConverter() if entry.isreg else None,
+                ).strip("/")
+                for entry in input_arc
+                if entry.isreg or entry.isdir
+            ]
+        with file_reader(str(out_path)) as output_arc:
+            found = [entry.pathname.strip("/") for entry in output_arc]
+
+        assert found == expected
+
     @pytest.mark.slow
     @pytest.mark.parametrize("ext", EXTENSIONS)
     def test_cb_to_cbz_jpegxl(self, test_data, tmp_path, ext):